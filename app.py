@@ -4,10 +4,48 @@ import numpy as np
 from datetime import datetime
 import io
 from openpyxl import Workbook
+from openpyxl.cell import WriteOnlyCell
 from openpyxl.styles import Font, PatternFill, Alignment, Border, Side
+from openpyxl.utils import get_column_letter
 import warnings
 warnings.filterwarnings('ignore')
 
+try:
+    import xlsxwriter
+except ImportError:  # 未安裝 xlsxwriter 時改用 openpyxl 生成報告
+    xlsxwriter = None
+
+try:
+    from numba import njit, prange
+except ImportError:  # numba 為可選依賴，未安裝時使用 NumPy 向量化計算
+    njit = None
+    prange = range
+
+try:
+    import python_calamine  # noqa: F401
+    EXCEL_READ_ENGINE = 'calamine'
+except ImportError:  # 未安裝 python-calamine 時使用 openpyxl 讀取
+    EXCEL_READ_ENGINE = 'openpyxl'
+
+try:
+    import numexpr
+except ImportError:  # numexpr 為可選依賴，未安裝時使用 NumPy 逐步計算
+    numexpr = None
+
+try:
+    import polars as pl
+except ImportError:  # polars 為可選依賴
+    pl = None
+
+# 以 polars 計算每個 Article 的門檻；約百萬行以上才比 pandas 快，預設關閉
+USE_POLARS = False
+
+# 行數達到此數量時才使用 numba 編譯版本，小數據量下 NumPy 已足夠快
+NUMBA_MIN_ROWS = 10000
+# 未安裝 numba 時，行數達到此數量且 numexpr 使用多執行緒才改用 numexpr 融合運算；
+# 單執行緒下 numexpr 比 NumPy 慢，10 萬行以下兩者均不足數毫秒（見 benchmark_rf_returns.py）
+NUMEXPR_MIN_ROWS = 100000
+
 # 設定頁面配置
 st.set_page_config(
     page_title="退貨建議分析系統",
@@ -15,67 +53,102 @@ st.set_page_config(
     layout="wide"
 )
 
-def convert_to_string_format(value):
-    """確保 Article 欄位為 12 位字符串格式"""
-    if pd.isna(value):
-        return ""
-    value_str = str(value).strip()
-    # 移除小數點（如果是浮點數）
-    if '.' in value_str:
-        value_str = value_str.split('.')[0]
-    # 確保是 12 位數字
-    if value_str.isdigit() and len(value_str) <= 12:
-        return value_str.zfill(12)
-    return value_str
+# 分析所需的輸入欄位及讀取時的類型
+INPUT_COLUMNS = ['Product Hierarchy', 'Article', 'Article Description', 'OM', 'RP Type', 'Site',
+                 'SaSa Net Stock', 'Pending Received', 'Safety Stock', 'Last Month Sold Qty', 'MTD Sold Qty']
+# OM / RP Type / Site 可能混合數字及文字（如 H001 與 101），讀取時保持字符串，
+# 由 preprocess_data 清理後再轉為 category
+INPUT_DTYPES = {
+    'Article': str,
+    'Article Description': str,
+    'OM': str,
+    'RP Type': str,
+    'Site': str
+}
 
-def safe_convert_to_int(value):
-    """安全轉換為整數，異常值設為 0"""
-    try:
-        if pd.isna(value):
-            return 0
-        return max(0, int(float(value)))
-    except:
-        return 0
-
-def safe_convert_to_string(value):
-    """安全轉換為字符串"""
-    if pd.isna(value):
-        return ""
-    return str(value).strip()
+def read_input_excel(source):
+    """只讀取分析所需欄位，並在讀取時指定欄位類型
+    
+    工作表的完整欄位名稱保存在 df.attrs['source_columns']，供欄位數統計及提示使用。
+    """
+    source_columns = {}
+    
+    def use_column(col):
+        source_columns[col] = None
+        return col in INPUT_COLUMNS
+    
+    read_options = dict(usecols=use_column, dtype=INPUT_DTYPES)
+    df = None
+    if EXCEL_READ_ENGINE == 'calamine':
+        try:
+            df = pd.read_excel(source, engine='calamine', **read_options)
+        except Exception:
+            # calamine 無法解析時改用 openpyxl 重新讀取
+            if hasattr(source, 'seek'):
+                source.seek(0)
+            source_columns.clear()
+    if df is None:
+        df = pd.read_excel(source, engine='openpyxl', **read_options)
+    df.attrs['source_columns'] = list(source_columns)
+    return df
 
 def preprocess_data(df):
     """數據預處理與驗證"""
-    df_processed = df.copy()
+    # 淺複製即可：以下每個處理欄位都以新的 Series 整欄賦值，不會改動呼叫者的數據
+    df_processed = df.copy(deep=False)
     
     # 確保 Article 欄位為 12 位字符串格式
-    df_processed['Article'] = df_processed['Article'].apply(convert_to_string_format)
+    article = df_processed['Article'].astype('string[pyarrow]').str.strip()
+    # 移除小數點及其後內容（如果是浮點數），1-12 位數字補零至 12 位
+    article = article.str.replace(r'\..*', '', regex=True)
+    is_digits = article.str.fullmatch(r'\d{1,12}').fillna(False).astype(bool)
+    df_processed['Article'] = article.where(~is_digits, article.str.zfill(12)).fillna("")
     
     # 字符串欄位處理
     string_columns = ['OM', 'RP Type', 'Site']
     for col in string_columns:
         if col in df_processed.columns:
-            df_processed[col] = df_processed[col].apply(safe_convert_to_string)
+            values = df_processed[col]
+            df_processed[col] = values.astype(str).str.strip().where(values.notna(), "")
+    
+    # 描述類文字欄位使用 pyarrow 字符串，以連續緩衝區取代 Python 物件
+    for col in ['Article Description', 'Product Hierarchy']:
+        if col in df_processed.columns:
+            df_processed[col] = df_processed[col].astype('string[pyarrow]').fillna("")
     
     # 整數欄位處理
     int_columns = ['SaSa Net Stock', 'Pending Received', 'Safety Stock', 'Last Month Sold Qty', 'MTD Sold Qty']
     for col in int_columns:
         if col in df_processed.columns:
-            df_processed[col] = df_processed[col].apply(safe_convert_to_int)
+            values = pd.to_numeric(df_processed[col], errors='coerce')
+            values = values.where(np.isfinite(values), 0)
+            # int32 足以容納庫存及銷量，較 int64 減半後續每次掃描的記憶體流量
+            df_processed[col] = values.clip(lower=0, upper=np.iinfo(np.int32).max).astype(np.int32)
     
     # 銷量異常值校正
-    df_processed['Notes'] = ""
+    notes = pd.Series("", index=df_processed.index)
     
-    for idx, row in df_processed.iterrows():
-        notes = []
-        
-        # 檢查銷量數據範圍
-        for col in ['Last Month Sold Qty', 'MTD Sold Qty']:
-            if col in df_processed.columns:
-                if row[col] > 100000:
-                    df_processed.loc[idx, col] = 100000
-                    notes.append(f'{col}銷量數據超出範圍')
-        
-        df_processed.loc[idx, 'Notes'] = '; '.join(notes)
+    for col in ['Last Month Sold Qty', 'MTD Sold Qty']:
+        if col in df_processed.columns:
+            mask = df_processed[col] > 100000
+            df_processed[col] = df_processed[col].clip(upper=100000)
+            col_notes = pd.Series(np.where(mask, f'{col}銷量數據超出範圍', ''), index=df_processed.index)
+            notes = notes.str.cat(col_notes, sep='; ')
+    
+    df_processed['Notes'] = notes.str.strip('; ').astype('string[pyarrow]')
+    
+    # 有效銷量只計算一次，門檻及 RF 條件直接重用此欄；每次預處理都按當前銷量重新計算
+    if 'Last Month Sold Qty' in df_processed.columns and 'MTD Sold Qty' in df_processed.columns:
+        last_month = df_processed['Last Month Sold Qty'].to_numpy()
+        df_processed['Effective Sold Qty'] = np.where(last_month > 0, last_month,
+                                                      df_processed['MTD Sold Qty'].to_numpy())
+    else:
+        df_processed = df_processed.drop(columns='Effective Sold Qty', errors='ignore')
+    
+    # 重複比較及分組的欄位轉為 category，比較與分組改用整數編碼
+    for col in ['OM', 'RP Type', 'Site', 'Article']:
+        if col in df_processed.columns:
+            df_processed[col] = df_processed[col].astype('category')
     
     return df_processed
 
@@ -90,23 +163,115 @@ def calculate_effective_sold_qty(row):
     else:
         return mtd
 
-def get_top20_percent_threshold(df, article):
-    """計算該 Article 的銷量前 20% 門檻"""
-    article_data = df[df['Article'] == article]
-    if article_data.empty:
-        return float('inf')
-    
-    sold_quantities = []
-    for _, row in article_data.iterrows():
-        effective_qty = calculate_effective_sold_qty(row)
-        sold_quantities.append(effective_qty)
-    
-    if not sold_quantities:
-        return float('inf')
-    
-    # 計算 80% 分位數（前 20% 的門檻）
-    threshold = np.percentile(sold_quantities, 80)
-    return threshold
+def calculate_effective_sold_qty_column(df):
+    """以整欄計算有效銷量（calculate_effective_sold_qty 的向量化版本）"""
+    if 'Effective Sold Qty' in df.columns:
+        return df['Effective Sold Qty']
+    last_month = df['Last Month Sold Qty'].to_numpy() if 'Last Month Sold Qty' in df.columns else 0
+    mtd = df['MTD Sold Qty'].to_numpy() if 'MTD Sold Qty' in df.columns else 0
+    effective_qty = np.where(np.asarray(last_month) > 0, last_month, mtd)
+    return pd.Series(np.broadcast_to(effective_qty, len(df)), index=df.index)
+
+def _polars_thresholds(df, effective_sold_qty):
+    """以 polars 計算每個 Article 的銷量前 20% 門檻（80% 分位數，線性插值與 pandas 一致）"""
+    thresholds = (
+        pl.from_pandas(pd.DataFrame({'Article': df['Article'], 'Effective Sold Qty': effective_sold_qty}))
+        .lazy()
+        .group_by('Article')
+        .agg(pl.col('Effective Sold Qty').quantile(0.8, interpolation='linear'))
+        .collect()
+    )
+    return pd.Series(thresholds['Effective Sold Qty'].to_numpy(), index=thresholds['Article'].to_list())
+
+def get_top20_percent_threshold_column(df, effective_sold_qty=None):
+    """逐行取得所屬 Article 的銷量前 20% 門檻，與 df 的行對齊"""
+    if effective_sold_qty is None:
+        effective_sold_qty = calculate_effective_sold_qty_column(df)
+    if USE_POLARS and pl is not None:
+        return df['Article'].map(_polars_thresholds(df, effective_sold_qty)).astype(float)
+    return effective_sold_qty.groupby(df['Article'], observed=True, sort=False).transform('quantile', q=0.8)
+
+def calculate_rf_returns(net_stock, pending_received, safety_stock, last_month_sold, mtd_sold,
+                         effective_sold_qty, top20_threshold):
+    """RF 類型過剩退倉計算（輸入為等長的 NumPy 陣列）
+    
+    Returns:
+        (是否符合退貨條件, 退貨數量)
+    """
+    if rf_returns_kernel is not None and len(net_stock) >= NUMBA_MIN_ROWS:
+        return rf_returns_kernel(net_stock, pending_received, safety_stock, last_month_sold, mtd_sold,
+                                 effective_sold_qty, top20_threshold)
+    
+    total_available = net_stock + pending_received
+    
+    # 根據銷售量調整退貨後淨餘數量要求
+    # 若上月銷售量/MTD銷售量 其中一個月 > Safety Qty：退貨後淨餘數量需高於 Safety Qty 的 25% 且至少 +2 件
+    # 若上月銷售量/MTD銷售量 同樣地 ≤ Safety Qty：退貨後淨餘數量只需高於 Safety Qty 1 件
+    high_sales = (last_month_sold > safety_stock) | (mtd_sold > safety_stock)
+    min_remaining = np.where(
+        high_sales,
+        np.maximum(np.maximum(np.trunc(safety_stock * 1.25), safety_stock + 2), 0),
+        np.maximum(safety_stock + 1, 0)
+    ).astype(np.int64)
+    
+    # 計算可退貨數量，最終退貨數量（至少 2 件）
+    if numexpr is not None and numexpr.get_num_threads() > 1 and len(net_stock) >= NUMEXPR_MIN_ROWS:
+        # numexpr 將剩餘運算融合為多執行緒單次遍歷，不產生中間陣列
+        variables = {
+            'net_stock': net_stock,
+            'total_available': total_available,
+            'safety_stock': safety_stock,
+            'min_remaining': min_remaining,
+            'effective_sold_qty': effective_sold_qty,
+            'top20_threshold': top20_threshold,
+        }
+        return_qty = numexpr.evaluate(
+            'where(safety_stock > min_remaining, total_available - safety_stock, total_available - min_remaining)',
+            local_dict=variables
+        )
+        variables['return_qty'] = return_qty
+        keep = numexpr.evaluate(
+            '(total_available > safety_stock) & (effective_sold_qty < top20_threshold)'
+            ' & (return_qty >= 2) & (return_qty <= net_stock)',
+            local_dict=variables
+        )
+        return keep, return_qty
+    
+    potential_return = total_available - safety_stock
+    max_return = total_available - min_remaining
+    return_qty = np.minimum(potential_return, max_return)
+    
+    keep = (
+        (total_available > safety_stock)
+        & (effective_sold_qty < top20_threshold)
+        & (return_qty >= 2)
+        & (return_qty <= net_stock)
+    )
+    return keep, return_qty
+
+def rf_returns_loop(net_stock, pending_received, safety_stock, last_month_sold, mtd_sold,
+                    effective_sold_qty, top20_threshold):
+    """calculate_rf_returns 的逐行版本，由 numba 編譯為單次遍歷、不產生中間陣列的機器碼"""
+    n = net_stock.shape[0]
+    keep = np.zeros(n, np.bool_)
+    return_qty = np.zeros(n, np.int64)
+    # 各行互相獨立，numba 編譯時以 prange 分配到多個執行緒
+    for i in prange(n):
+        total_available = net_stock[i] + pending_received[i]
+        if total_available <= safety_stock[i] or effective_sold_qty[i] >= top20_threshold[i]:
+            continue
+        if last_month_sold[i] > safety_stock[i] or mtd_sold[i] > safety_stock[i]:
+            min_remaining = max(int(safety_stock[i] * 1.25), safety_stock[i] + 2, 0)
+        else:
+            min_remaining = max(safety_stock[i] + 1, 0)
+        qty = min(total_available - safety_stock[i], total_available - min_remaining)
+        return_qty[i] = qty
+        if 2 <= qty <= net_stock[i]:
+            keep[i] = True
+    return keep, return_qty
+
+# 門檻含 inf，不可使用 fastmath
+rf_returns_kernel = njit(cache=True, parallel=True, nogil=True)(rf_returns_loop) if njit is not None else None
 
 def generate_return_recommendations(df, calculation_type="both"):
     """生成退貨建議
@@ -115,121 +280,273 @@ def generate_return_recommendations(df, calculation_type="both"):
         df: 數據框架
         calculation_type: 計算類型 ('nd_only', 'rf_only', 'both')
     """
-    recommendations = []
-    
-    for _, row in df.iterrows():
-        article = row['Article']
-        om = row['OM']
-        rp_type = row['RP Type']
-        site = row['Site']
-        net_stock = row['SaSa Net Stock']
-        pending_received = row['Pending Received']
-        safety_stock = row['Safety Stock']
-        last_month_sold = row.get('Last Month Sold Qty', 0)
-        mtd_sold = row.get('MTD Sold Qty', 0)
-        product_hierarchy = row.get('Product Hierarchy', '')
-        
-        effective_sold_qty = calculate_effective_sold_qty(row)
-        
-        # ND 類型退倉
-        if rp_type == "ND" and net_stock > 0:
-            # 判斷是否應該退貨
-            should_return = False
-            
-            if calculation_type in ["nd_only", "both"]:
-                # ND Only 和 Both 模式：全部退
-                should_return = True
-            elif calculation_type == "nd_shop_only":
-                # Only ND 店舖(MTD無銷售的全退)：只有 MTD 銷售量 = 0 才全退
-                if mtd_sold == 0:
-                    should_return = True
-            
-            if should_return:
-                return_qty = net_stock
-                remaining_stock = net_stock - return_qty
-                
-                notes_parts = ['ND類型退倉']
-                
-                # 檢查是否有銷售記錄
-                if effective_sold_qty > 0 and calculation_type != "nd_shop_only":
-                    notes_parts.append('曾有銷售記錄, Buyer需要留意是否需轉成RF及設定Safety')
-                
-                if row.get("Notes"):
-                    notes_parts.append(row.get("Notes"))
-                
-                recommendations.append({
-                    'Article': article,
-                    'Product Desc': row.get('Article Description', ''),
-                    'Product Hierarchy': product_hierarchy,
-                    'OM': om,
-                    'Return Site': site,
-                    'Receive Site': 'D001',
-                    'Return Qty': return_qty,
-                    'RP Type': rp_type,
-                    'Stock Qty': net_stock,
-                    'Safety Qty': safety_stock,
-                    'Last Month Sold Qty': last_month_sold,
-                    'MTD Sold Qty': mtd_sold,
-                    'Remaining Stock After Return': remaining_stock,
-                    'Notes': '; '.join(notes_parts),
-                    'Type': 'ND'
-                })
-        
-        # RF 類型過剩退倉
-        elif rp_type == "RF" and calculation_type in ["rf_only", "both"]:
-            total_available = net_stock + pending_received
-            
-            # 檢查條件：庫存充足
-            if total_available > safety_stock:
-                # 檢查銷量是否非最高 20%
-                top20_threshold = get_top20_percent_threshold(df, article)
-                
-                if effective_sold_qty < top20_threshold:
-                    # 根據銷售量調整退貨後淨餘數量要求
-                    # 若上月銷售量/MTD銷售量 其中一個月 > Safety Qty：退貨後淨餘數量需高於 Safety Qty 的 25% / +2件
-                    # 若上月銷售量/MTD銷售量 同樣地 ≤ Safety Qty：退貨後淨餘數量只需高於 Safety Qty 1 件
-                    if last_month_sold > safety_stock or mtd_sold > safety_stock:
-                        # 銷售量高於 Safety Qty：退貨後淨餘數量需高於 Safety Qty 的 25% 且至少 +2 件
-                        min_remaining_25_percent = int(safety_stock * 1.25)
-                        min_remaining_2_more = safety_stock + 2
-                        min_remaining = max(min_remaining_25_percent, min_remaining_2_more, 0)
-                    else:
-                        # 銷售量少於 Safety Qty：退貨後淨餘數量只需要高於 Safety Qty 1 件
-                        min_remaining = max(safety_stock + 1, 0)
-                    
-                    # 計算可退貨數量
-                    potential_return = total_available - safety_stock
-                    max_return = total_available - min_remaining
-                    
-                    # 最終退貨數量（至少 2 件）
-                    return_qty = min(potential_return, max_return)
-                    
-                    if return_qty >= 2 and return_qty <= net_stock:
-                        remaining_stock = net_stock - return_qty
-                        
-                        notes_parts = ['RF類型過剩退倉']
-                        if row.get("Notes"):
-                            notes_parts.append(row.get("Notes"))
-                        
-                        recommendations.append({
-                            'Article': article,
-                            'Product Desc': row.get('Article Description', ''),
-                            'Product Hierarchy': product_hierarchy,
-                            'OM': om,
-                            'Return Site': site,
-                            'Receive Site': 'D001',
-                            'Return Qty': return_qty,
-                            'RP Type': rp_type,
-                            'Stock Qty': net_stock,
-                            'Safety Qty': safety_stock,
-                            'Last Month Sold Qty': last_month_sold,
-                            'MTD Sold Qty': mtd_sold,
-                            'Remaining Stock After Return': remaining_stock,
-                            'Notes': '; '.join(notes_parts),
-                            'Type': 'RF'
-                        })
-    
-    return pd.DataFrame(recommendations)
+    def column(name, default):
+        return df[name] if name in df.columns else pd.Series(default, index=df.index)
+    
+    effective_sold_qty = calculate_effective_sold_qty_column(df)
+    
+    # ND 類型退倉
+    # ND Only 和 Both 模式：全部退
+    nd_mask = (df['RP Type'] == "ND") & (df['SaSa Net Stock'] > 0)
+    if calculation_type == "nd_shop_only":
+        # Only ND 店舖(MTD無銷售的全退)：只有 MTD 銷售量 = 0 才全退
+        nd_mask &= (column('MTD Sold Qty', 0) == 0)
+    elif calculation_type not in ["nd_only", "both"]:
+        nd_mask &= False
+    
+    # RF 類型過剩退倉
+    rf_mask = (df['RP Type'] == "RF") & (calculation_type in ["rf_only", "both"])
+    
+    # 先篩出與計算類型相關的行，之後的計算只在這部分數據上進行
+    candidates = nd_mask | rf_mask
+    if not candidates.any():
+        return pd.DataFrame()
+    
+    # 前 20% 門檻按該 Article 的所有店鋪計算，須在篩選前以完整數據進行；沒有 RF 行時略過
+    if rf_mask.any():
+        top20_threshold = get_top20_percent_threshold_column(df, effective_sold_qty)
+    else:
+        top20_threshold = pd.Series(float('inf'), index=df.index)
+    
+    df = df.loc[candidates]
+    nd_mask = nd_mask[candidates]
+    rf_mask = rf_mask[candidates]
+    effective_sold_qty = effective_sold_qty[candidates]
+    top20_threshold = top20_threshold[candidates].fillna(float('inf'))
+    
+    rp_type = df['RP Type']
+    net_stock = df['SaSa Net Stock']
+    safety_stock = df['Safety Stock']
+    last_month_sold = column('Last Month Sold Qty', 0)
+    mtd_sold = column('MTD Sold Qty', 0)
+    row_notes = column('Notes', '')
+    
+    rf_keep, rf_return_qty = calculate_rf_returns(
+        net_stock.to_numpy(np.int64),
+        df['Pending Received'].to_numpy(np.int64),
+        safety_stock.to_numpy(np.int64),
+        last_month_sold.to_numpy(np.int64),
+        mtd_sold.to_numpy(np.int64),
+        effective_sold_qty.to_numpy(np.int64),
+        top20_threshold.to_numpy()
+    )
+    rf_mask &= rf_keep
+    
+    mask = (nd_mask | rf_mask).to_numpy()
+    if not mask.any():
+        return pd.DataFrame()
+    
+    # 直接以欄位陣列建立結果，不逐行建立 dict
+    is_nd = nd_mask.to_numpy()[mask]
+    stock_qty = net_stock.to_numpy()[mask]
+    return_qty = np.where(is_nd, stock_qty, rf_return_qty[mask])
+    
+    # 備註：類型說明、銷售記錄提示（ND）及預處理備註，以 '; ' 串接並移除空白項
+    # 檢查是否有銷售記錄
+    has_sales = is_nd & (effective_sold_qty.to_numpy()[mask] > 0) & (calculation_type != "nd_shop_only")
+    notes = pd.Series(np.where(is_nd, 'ND類型退倉', 'RF類型過剩退倉')).str.cat(
+        [
+            pd.Series(np.where(has_sales, '曾有銷售記錄, Buyer需要留意是否需轉成RF及設定Safety', '')),
+            pd.Series(row_notes.to_numpy()[mask]).fillna('').astype(str)
+        ],
+        sep='; '
+    ).str.replace(r'(?:; )+(?=; |$)', '', regex=True)
+    
+    return pd.DataFrame({
+        'Article': df['Article'].array[mask],
+        'Product Desc': column('Article Description', '').array[mask],
+        'Product Hierarchy': column('Product Hierarchy', '').array[mask],
+        'OM': df['OM'].array[mask],
+        'Return Site': df['Site'].array[mask],
+        'Receive Site': 'D001',
+        'Return Qty': return_qty,
+        'RP Type': rp_type.array[mask],
+        'Stock Qty': stock_qty,
+        'Safety Qty': safety_stock.to_numpy()[mask],
+        'Last Month Sold Qty': last_month_sold.to_numpy()[mask],
+        'MTD Sold Qty': mtd_sold.to_numpy()[mask],
+        'Remaining Stock After Return': stock_qty - return_qty,
+        'Notes': notes.to_numpy(),
+        'Type': pd.Categorical(np.where(is_nd, 'ND', 'RF'), categories=['ND', 'RF'])
+    })
+
+# Excel 報告欄位及列寬
+REPORT_HEADERS = ['Product Hierarchy', 'Article', 'Product Desc', 'OM', 'Return Site', 'Receive Site', 'Return Qty',
+                  'RP Type', 'Stock Qty', 'Safety Qty', 'Last Month Sold Qty', 'MTD Sold Qty',
+                  'Remaining Stock After Return', 'Notes']
+REPORT_COLUMN_WIDTHS = [12, 15, 30, 10, 15, 15, 12, 10, 12, 12, 18, 15, 25, 40]
+SUMMARY_COLUMN_WIDTH = 18
+SUMMARY_COLUMN_COUNT = 8
+
+def build_summary_rows(recommendations_df, df_original, calculation_type="both"):
+    """按順序生成統計摘要工作表的每一行
+    
+    每行為 (values, styles)：styles 為 None 表示整行無樣式，
+    否則為與 values 對應的樣式名稱列表（'kpi_title'、'type_title'、'bold'、'section'、'header' 或 None）。
+    """
+    # KPI 橫幅
+    total_recommendations = len(recommendations_df)
+    total_return_qty = recommendations_df['Return Qty'].sum() if not recommendations_df.empty else 0
+    
+    # 分析類型說明
+    type_descriptions = {
+        "nd_only": "ND 類型退倉分析",
+        "nd_shop_only": "只退 ND 店舖(MTD無銷售的全退)分析",
+        "rf_only": "RF 類型過剩退倉分析",
+        "both": "綜合退貨分析 (ND + RF)"
+    }
+    analysis_type_desc = type_descriptions.get(calculation_type, "綜合分析")
+    
+    blank = ([], None)
+    
+    def section(title):
+        return [([title], ['section']), blank]
+    
+    def header(values):
+        return (values, ['header'] * len(values))
+    
+    yield ["KPI 摘要"], ['kpi_title']
+    yield [f"分析類型: {analysis_type_desc}"], ['type_title']
+    yield blank
+    yield ["總退貨建議數量（條數）:", total_recommendations], ['bold', None]
+    yield ["總退貨件數:", total_return_qty], ['bold', None]
+    yield blank
+    yield blank
+    
+    # 詳細統計表
+    if recommendations_df.empty:
+        return
+    
+    # 按 Article 統計
+    yield from section("按 Article 統計")
+    yield header(["Article", "總退貨件數", "涉及OM數量"])
+    
+    article_stats = recommendations_df.groupby('Article', sort=False, observed=True).agg(
+        return_qty=('Return Qty', 'sum'),
+        om_count=('OM', 'nunique')
+    ).reset_index()
+    
+    for row in article_stats.itertuples(index=False, name=None):
+        yield row, None
+    
+    yield blank
+    yield blank
+    
+    # 按 OM 統計
+    yield from section("按 OM 統計")
+    yield header(["OM", "總退貨件數", "涉及Article數量"])
+    
+    om_stats = recommendations_df.groupby('OM', sort=False, observed=True).agg(
+        return_qty=('Return Qty', 'sum'),
+        article_count=('Article', 'nunique')
+    ).reset_index()
+    
+    for row in om_stats.itertuples(index=False, name=None):
+        yield row, None
+    
+    yield blank
+    yield blank
+    
+    # 轉出類型分布
+    yield from section("轉出類型分布")
+    
+    type_stats = recommendations_df.groupby('Type', sort=False, observed=True).agg(
+        count=('Return Qty', 'size'),
+        return_qty=('Return Qty', 'sum')
+    ).reset_index()
+    
+    yield header(["類型", "建議數量", "總件數"])
+    
+    for row in type_stats.itertuples(index=False, name=None):
+        yield row, None
+    
+    yield blank
+    yield blank
+    
+    # 退貨前合計統計（按 Article 及 Product Desc 分類）
+    yield from section("退貨前合計統計（按 Article 及 Product Desc 分類）")
+    yield header(["Article", "Product Desc", "原有存貨", "上月銷售", "MTD銷售",
+                  "Safety QTY", "退貨總數量", "退貨後存貨"])
+    
+    # 按 Article 分組統計 (從原始數據獲取所有 Site 的總計)
+    # 同一 Article 只佔一行，Product Desc 取該 Article 第一個非空白的描述
+    descriptions = df_original['Article Description']
+    original_article_stats = df_original.assign(
+        **{'Article Description': descriptions.mask(descriptions == '')}
+    ).groupby('Article', sort=False, observed=True).agg({
+        'Article Description': 'first',
+        'SaSa Net Stock': 'sum',
+        'Last Month Sold Qty': 'sum',
+        'MTD Sold Qty': 'sum',
+        'Safety Stock': 'sum'
+    }).reset_index()
+    original_article_stats['Article Description'] = original_article_stats['Article Description'].fillna('')
+    
+    # 每個 Article 的退貨總量直接沿用上方按 Article 統計的結果
+    return_article_stats = article_stats[['Article', 'return_qty']].rename(columns={'return_qty': 'Return Qty'})
+    
+    # 合併數據
+    article_summary = pd.merge(
+        original_article_stats,
+        return_article_stats,
+        on='Article',
+        how='inner' # 只顯示有退貨建議的 Article
+    )
+    
+    # 計算退貨後存貨
+    article_summary['Remaining Stock After Return'] = article_summary['SaSa Net Stock'] - article_summary['Return Qty']
+    
+    # 重新命名欄位以匹配 Excel 標題
+    article_summary = article_summary.rename(columns={
+        'Article Description': 'Product Desc',
+        'SaSa Net Stock': 'Stock Qty',
+        'Safety Stock': 'Safety Qty'
+    })
+    
+    summary_columns = ['Article', 'Product Desc', 'Stock Qty', 'Last Month Sold Qty', 'MTD Sold Qty',
+                       'Safety Qty', 'Return Qty', 'Remaining Stock After Return']
+    for row in article_summary[summary_columns].itertuples(index=False, name=None):
+        yield row, None
+    
+    yield blank
+    yield blank
+    
+    # 所有店鋪總計數據
+    yield from section("所有店鋪總計")
+    
+    # 計算所有店鋪的總計數據
+    total_original_stock = df_original['SaSa Net Stock'].sum() if 'SaSa Net Stock' in df_original.columns else 0
+    total_last_month_sold = df_original['Last Month Sold Qty'].sum() if 'Last Month Sold Qty' in df_original.columns else 0
+    total_mtd_sold = df_original['MTD Sold Qty'].sum() if 'MTD Sold Qty' in df_original.columns else 0
+    total_safety_stock = df_original['Safety Stock'].sum() if 'Safety Stock' in df_original.columns else 0
+    total_return_qty = recommendations_df['Return Qty'].sum() if 'Return Qty' in recommendations_df.columns else 0
+    total_remaining_stock = total_original_stock - total_return_qty
+    
+    for label, value in [
+        ("原有存貨", total_original_stock),
+        ("上月銷售", total_last_month_sold),
+        ("MTD銷售", total_mtd_sold),
+        ("Safety QTY", total_safety_stock),
+        ("退貨總數量", total_return_qty),
+        ("退貨後存貨", total_remaining_stock)
+    ]:
+        yield [label, value], ['header', None]
+    
+    yield blank
+    yield blank
+    
+    # 退貨類型說明
+    yield from section("退貨類型說明")
+    yield header(["類型", "說明"])
+    
+    type_explanations = [
+        ['ND', 'ND類型退倉：退回全部現有庫存至D001倉庫。如有銷售記錄，系統會提示 Buyer 需要留意是否需轉成 RF 及設定 Safety Stock'],
+        ['ND_SHOP', '只退 ND 店舖(MTD無銷售的全退)：專門分析 ND 類型的店舖，只有當 MTD 銷售量 = 0 時才將所有現有庫存退回至 D001 倉庫。若 MTD 銷售量 > 0 則不退貨'],
+        ['RF', 'RF類型過剩退倉：退回過剩庫存（庫存充足且非高銷量店鋪）。若上月銷售量/MTD銷售量 其中一個月 > Safety Qty，退貨後淨餘數量需高於 Safety Qty 的 25% 且至少 +2 件；若上月銷售量/MTD銷售量 同樣地 ≤ Safety Qty，退貨後淨餘數量只需高於 Safety Qty 1 件']
+    ]
+    
+    for explanation in type_explanations:
+        yield explanation, None
 
 def create_excel_report(recommendations_df, df_original, calculation_type="both"):
     """創建 Excel 報告
@@ -239,8 +556,8 @@ def create_excel_report(recommendations_df, df_original, calculation_type="both"
         df_original: 原始數據框架
         calculation_type: 計算類型 ('nd_only', 'rf_only', 'both')
     """
-    # 創建工作簿
-    wb = Workbook()
+    # 創建工作簿（write-only 模式逐行寫出，記憶體佔用不隨行數增長）
+    wb = Workbook(write_only=True)
     
     # 定義樣式
     header_font = Font(bold=True, color="FFFFFF")
@@ -251,273 +568,127 @@ def create_excel_report(recommendations_df, df_original, calculation_type="both"
         top=Side(style='thin'),
         bottom=Side(style='thin')
     )
+    styles = {
+        'kpi_title': {'font': Font(size=16, bold=True)},
+        'type_title': {'font': Font(size=12, bold=True)},
+        'bold': {'font': Font(bold=True)},
+        'section': {'font': Font(size=14, bold=True)},
+        'header': {'font': header_font, 'fill': header_fill},
+        'column_header': {'font': header_font, 'fill': header_fill, 'border': border,
+                          'alignment': Alignment(horizontal='center')}
+    }
+    
+    def styled_cell(ws, value, style):
+        if style is None:
+            return value
+        cell = WriteOnlyCell(ws, value=value)
+        for attr, style_value in styles[style].items():
+            setattr(cell, attr, style_value)
+        return cell
     
     # 工作表 1: 退貨建議
-    ws1 = wb.active
-    ws1.title = "退貨建議"
+    ws1 = wb.create_sheet("退貨建議")
+    
+    # 調整列寬（write-only 模式需在寫入數據前設定）
+    for col_num, width in enumerate(REPORT_COLUMN_WIDTHS, 1):
+        ws1.column_dimensions[get_column_letter(col_num)].width = width
     
     # 寫入標題行
-    headers = ['Product Hierarchy', 'Article', 'Product Desc', 'OM', 'Return Site', 'Receive Site', 'Return Qty',
-               'RP Type', 'Stock Qty', 'Safety Qty', 'Last Month Sold Qty', 'MTD Sold Qty',
-               'Remaining Stock After Return', 'Notes']
-    for col_num, header in enumerate(headers, 1):
-        cell = ws1.cell(row=1, column=col_num, value=header)
-        cell.font = header_font
-        cell.fill = header_fill
-        cell.border = border
-        cell.alignment = Alignment(horizontal='center')
+    ws1.append([styled_cell(ws1, header, 'column_header') for header in REPORT_HEADERS])
     
     # 寫入數據
-    for row_num, (_, row) in enumerate(recommendations_df.iterrows(), 2):
-        for col_num, header in enumerate(headers, 1):
-            cell = ws1.cell(row=row_num, column=col_num, value=row[header])
-            cell.border = border
-    
-    # 調整列寬
-    column_widths = [12, 15, 30, 10, 15, 15, 12, 10, 12, 12, 18, 15, 25, 40]
-    for col_num, width in enumerate(column_widths, 1):
-        ws1.column_dimensions[ws1.cell(row=1, column=col_num).column_letter].width = width
+    if not recommendations_df.empty:
+        for row in recommendations_df[REPORT_HEADERS].itertuples(index=False, name=None):
+            ws1.append(row)
     
     # 工作表 2: 統計摘要
     ws2 = wb.create_sheet("統計摘要")
     
-    # KPI 橫幅
-    total_recommendations = len(recommendations_df)
-    total_return_qty = recommendations_df['Return Qty'].sum() if not recommendations_df.empty else 0
+    # 調整列寬
+    for col_num in range(1, SUMMARY_COLUMN_COUNT + 1):
+        ws2.column_dimensions[get_column_letter(col_num)].width = SUMMARY_COLUMN_WIDTH
     
-    # 分析類型說明
-    type_descriptions = {
-        "nd_only": "ND 類型退倉分析",
-        "nd_shop_only": "只退 ND 店舖(MTD無銷售的全退)分析",
-        "rf_only": "RF 類型過剩退倉分析",
-        "both": "綜合退貨分析 (ND + RF)"
+    for values, row_styles in build_summary_rows(recommendations_df, df_original, calculation_type):
+        if row_styles is None:
+            ws2.append(values)
+        else:
+            ws2.append([styled_cell(ws2, value, style) for value, style in zip(values, row_styles)])
+    
+    return wb
+
+def write_excel_report_xlsxwriter(recommendations_df, df_original, calculation_type, output):
+    """以 xlsxwriter 的 constant_memory 模式寫出 Excel 報告，內容與 create_excel_report 相同
+    
+    constant_memory 模式只保留當前一行於記憶體，因此所有內容必須按行由上至下寫入。
+    """
+    workbook = xlsxwriter.Workbook(output, {
+        'constant_memory': True,
+        'strings_to_formulas': False,
+        'strings_to_urls': False
+    })
+    
+    header_style = {'bold': True, 'font_color': 'white', 'bg_color': '#366092', 'pattern': 1}
+    formats = {
+        'kpi_title': workbook.add_format({'bold': True, 'font_size': 16}),
+        'type_title': workbook.add_format({'bold': True, 'font_size': 12}),
+        'bold': workbook.add_format({'bold': True}),
+        'section': workbook.add_format({'bold': True, 'font_size': 14}),
+        'header': workbook.add_format(header_style),
+        'column_header': workbook.add_format(dict(header_style, border=1, align='center'))
     }
-    analysis_type_desc = type_descriptions.get(calculation_type, "綜合分析")
     
-    ws2.cell(row=1, column=1, value="KPI 摘要").font = Font(size=16, bold=True)
-    ws2.cell(row=2, column=1, value=f"分析類型: {analysis_type_desc}").font = Font(size=12, bold=True)
-    ws2.cell(row=4, column=1, value="總退貨建議數量（條數）:").font = Font(bold=True)
-    ws2.cell(row=4, column=2, value=total_recommendations)
-    ws2.cell(row=5, column=1, value="總退貨件數:").font = Font(bold=True)
-    ws2.cell(row=5, column=2, value=total_return_qty)
+    # 工作表 1: 退貨建議
+    ws1 = workbook.add_worksheet("退貨建議")
+    for col_num, width in enumerate(REPORT_COLUMN_WIDTHS):
+        ws1.set_column(col_num, col_num, width)
     
-    # 詳細統計表
-    current_row = 8
+    ws1.write_row(0, 0, REPORT_HEADERS, formats['column_header'])
     
     if not recommendations_df.empty:
-        # 按 Article 統計
-        ws2.cell(row=current_row, column=1, value="按 Article 統計").font = Font(size=14, bold=True)
-        current_row += 2
-        
-        ws2.cell(row=current_row, column=1, value="Article").font = header_font
-        ws2.cell(row=current_row, column=1).fill = header_fill
-        ws2.cell(row=current_row, column=2, value="總退貨件數").font = header_font
-        ws2.cell(row=current_row, column=2).fill = header_fill
-        ws2.cell(row=current_row, column=3, value="涉及OM數量").font = header_font
-        ws2.cell(row=current_row, column=3).fill = header_fill
-        current_row += 1
-        
-        article_stats = recommendations_df.groupby('Article').agg({
-            'Return Qty': 'sum',
-            'OM': 'nunique'
-        }).reset_index()
-        
-        for _, row in article_stats.iterrows():
-            ws2.cell(row=current_row, column=1, value=row['Article'])
-            ws2.cell(row=current_row, column=2, value=row['Return Qty'])
-            ws2.cell(row=current_row, column=3, value=row['OM'])
-            current_row += 1
-        
-        current_row += 2
-        
-        # 按 OM 統計
-        ws2.cell(row=current_row, column=1, value="按 OM 統計").font = Font(size=14, bold=True)
-        current_row += 2
-        
-        ws2.cell(row=current_row, column=1, value="OM").font = header_font
-        ws2.cell(row=current_row, column=1).fill = header_fill
-        ws2.cell(row=current_row, column=2, value="總退貨件數").font = header_font
-        ws2.cell(row=current_row, column=2).fill = header_fill
-        ws2.cell(row=current_row, column=3, value="涉及Article數量").font = header_font
-        ws2.cell(row=current_row, column=3).fill = header_fill
-        current_row += 1
-        
-        om_stats = recommendations_df.groupby('OM').agg({
-            'Return Qty': 'sum',
-            'Article': 'nunique'
-        }).reset_index()
-        
-        for _, row in om_stats.iterrows():
-            ws2.cell(row=current_row, column=1, value=row['OM'])
-            ws2.cell(row=current_row, column=2, value=row['Return Qty'])
-            ws2.cell(row=current_row, column=3, value=row['Article'])
-            current_row += 1
-        
-        current_row += 2
-        
-        # 轉出類型分布
-        ws2.cell(row=current_row, column=1, value="轉出類型分布").font = Font(size=14, bold=True)
-        current_row += 2
-        
-        type_stats = recommendations_df.groupby('Type').agg({
-            'Return Qty': ['count', 'sum']
-        }).round(2)
-        type_stats.columns = ['建議數量', '總件數']
-        type_stats = type_stats.reset_index()
-        
-        ws2.cell(row=current_row, column=1, value="類型").font = header_font
-        ws2.cell(row=current_row, column=1).fill = header_fill
-        ws2.cell(row=current_row, column=2, value="建議數量").font = header_font
-        ws2.cell(row=current_row, column=2).fill = header_fill
-        ws2.cell(row=current_row, column=3, value="總件數").font = header_font
-        ws2.cell(row=current_row, column=3).fill = header_fill
-        current_row += 1
-        
-        for _, row in type_stats.iterrows():
-            ws2.cell(row=current_row, column=1, value=row['Type'])
-            ws2.cell(row=current_row, column=2, value=row['建議數量'])
-            ws2.cell(row=current_row, column=3, value=row['總件數'])
-            current_row += 1
-        
-        current_row += 2
-        
-        # 退貨前合計統計（按 Article 及 Product Desc 分類）
-        ws2.cell(row=current_row, column=1, value="退貨前合計統計（按 Article 及 Product Desc 分類）").font = Font(size=14, bold=True)
-        current_row += 2
-        
-        ws2.cell(row=current_row, column=1, value="Article").font = header_font
-        ws2.cell(row=current_row, column=1).fill = header_fill
-        ws2.cell(row=current_row, column=2, value="Product Desc").font = header_font
-        ws2.cell(row=current_row, column=2).fill = header_fill
-        ws2.cell(row=current_row, column=3, value="原有存貨").font = header_font
-        ws2.cell(row=current_row, column=3).fill = header_fill
-        ws2.cell(row=current_row, column=4, value="上月銷售").font = header_font
-        ws2.cell(row=current_row, column=4).fill = header_fill
-        ws2.cell(row=current_row, column=5, value="MTD銷售").font = header_font
-        ws2.cell(row=current_row, column=5).fill = header_fill
-        ws2.cell(row=current_row, column=6, value="Safety QTY").font = header_font
-        ws2.cell(row=current_row, column=6).fill = header_fill
-        ws2.cell(row=current_row, column=7, value="退貨總數量").font = header_font
-        ws2.cell(row=current_row, column=7).fill = header_fill
-        ws2.cell(row=current_row, column=8, value="退貨後存貨").font = header_font
-        ws2.cell(row=current_row, column=8).fill = header_fill
-        current_row += 1
-        
-        # 按 Article 及 Product Desc 分組統計 (從原始數據獲取所有 Site 的總計)
-        # 首先從原始數據計算每個 Article 的總計
-        original_article_stats = df_original.groupby(['Article', 'Article Description']).agg({
-            'SaSa Net Stock': 'sum',
-            'Last Month Sold Qty': 'sum',
-            'MTD Sold Qty': 'sum',
-            'Safety Stock': 'sum'
-        }).reset_index()
-        
-        # 從建議數據計算每個 Article 的退貨總量
-        return_article_stats = recommendations_df.groupby('Article').agg({
-            'Return Qty': 'sum'
-        }).reset_index()
-        
-        # 合併數據
-        article_summary = pd.merge(
-            original_article_stats,
-            return_article_stats,
-            on='Article',
-            how='inner' # 只顯示有退貨建議的 Article
-        )
-        
-        # 計算退貨後存貨
-        article_summary['Remaining Stock After Return'] = article_summary['SaSa Net Stock'] - article_summary['Return Qty']
-        
-        # 重新命名欄位以匹配 Excel 標題
-        article_summary = article_summary.rename(columns={
-            'Article Description': 'Product Desc',
-            'SaSa Net Stock': 'Stock Qty',
-            'Safety Stock': 'Safety Qty'
-        })
-        
-        for _, row in article_summary.iterrows():
-            ws2.cell(row=current_row, column=1, value=row['Article'])
-            ws2.cell(row=current_row, column=2, value=row['Product Desc'])
-            ws2.cell(row=current_row, column=3, value=row['Stock Qty'])
-            ws2.cell(row=current_row, column=4, value=row['Last Month Sold Qty'])
-            ws2.cell(row=current_row, column=5, value=row['MTD Sold Qty'])
-            ws2.cell(row=current_row, column=6, value=row['Safety Qty'])
-            ws2.cell(row=current_row, column=7, value=row['Return Qty'])
-            ws2.cell(row=current_row, column=8, value=row['Remaining Stock After Return'])
-            current_row += 1
-        
-        current_row += 2
-        
-        # 所有店鋪總計數據
-        ws2.cell(row=current_row, column=1, value="所有店鋪總計").font = Font(size=14, bold=True)
-        current_row += 2
-        
-        # 計算所有店鋪的總計數據
-        total_original_stock = df_original['SaSa Net Stock'].sum() if 'SaSa Net Stock' in df_original.columns else 0
-        total_last_month_sold = df_original['Last Month Sold Qty'].sum() if 'Last Month Sold Qty' in df_original.columns else 0
-        total_mtd_sold = df_original['MTD Sold Qty'].sum() if 'MTD Sold Qty' in df_original.columns else 0
-        total_safety_stock = df_original['Safety Stock'].sum() if 'Safety Stock' in df_original.columns else 0
-        total_return_qty = recommendations_df['Return Qty'].sum() if 'Return Qty' in recommendations_df.columns else 0
-        total_remaining_stock = total_original_stock - total_return_qty
-        
-        ws2.cell(row=current_row, column=1, value="原有存貨").font = header_font
-        ws2.cell(row=current_row, column=1).fill = header_fill
-        ws2.cell(row=current_row, column=2, value=total_original_stock)
-        current_row += 1
-        
-        ws2.cell(row=current_row, column=1, value="上月銷售").font = header_font
-        ws2.cell(row=current_row, column=1).fill = header_fill
-        ws2.cell(row=current_row, column=2, value=total_last_month_sold)
-        current_row += 1
-        
-        ws2.cell(row=current_row, column=1, value="MTD銷售").font = header_font
-        ws2.cell(row=current_row, column=1).fill = header_fill
-        ws2.cell(row=current_row, column=2, value=total_mtd_sold)
-        current_row += 1
-        
-        ws2.cell(row=current_row, column=1, value="Safety QTY").font = header_font
-        ws2.cell(row=current_row, column=1).fill = header_fill
-        ws2.cell(row=current_row, column=2, value=total_safety_stock)
-        current_row += 1
-        
-        ws2.cell(row=current_row, column=1, value="退貨總數量").font = header_font
-        ws2.cell(row=current_row, column=1).fill = header_fill
-        ws2.cell(row=current_row, column=2, value=total_return_qty)
-        current_row += 1
-        
-        ws2.cell(row=current_row, column=1, value="退貨後存貨").font = header_font
-        ws2.cell(row=current_row, column=1).fill = header_fill
-        ws2.cell(row=current_row, column=2, value=total_remaining_stock)
-        current_row += 1
-        
-        current_row += 2
-        
-        # 退貨類型說明
-        ws2.cell(row=current_row, column=1, value="退貨類型說明").font = Font(size=14, bold=True)
-        current_row += 2
-        
-        ws2.cell(row=current_row, column=1, value="類型").font = header_font
-        ws2.cell(row=current_row, column=1).fill = header_fill
-        ws2.cell(row=current_row, column=2, value="說明").font = header_font
-        ws2.cell(row=current_row, column=2).fill = header_fill
-        current_row += 1
-        
-        type_explanations = [
-            ['ND', 'ND類型退倉：退回全部現有庫存至D001倉庫。如有銷售記錄，系統會提示 Buyer 需要留意是否需轉成 RF 及設定 Safety Stock'],
-            ['ND_SHOP', '只退 ND 店舖(MTD無銷售的全退)：專門分析 ND 類型的店舖，只有當 MTD 銷售量 = 0 時才將所有現有庫存退回至 D001 倉庫。若 MTD 銷售量 > 0 則不退貨'],
-            ['RF', 'RF類型過剩退倉：退回過剩庫存（庫存充足且非高銷量店鋪）。若上月銷售量/MTD銷售量 其中一個月 > Safety Qty，退貨後淨餘數量需高於 Safety Qty 的 25% 且至少 +2 件；若上月銷售量/MTD銷售量 同樣地 ≤ Safety Qty，退貨後淨餘數量只需高於 Safety Qty 1 件']
-        ]
-        
-        for explanation in type_explanations:
-            ws2.cell(row=current_row, column=1, value=explanation[0])
-            ws2.cell(row=current_row, column=2, value=explanation[1])
-            current_row += 1
+        for row_num, row in enumerate(recommendations_df[REPORT_HEADERS].itertuples(index=False, name=None), 1):
+            ws1.write_row(row_num, 0, row)
     
-    # 調整列寬
-    for col in ['A', 'B', 'C', 'D', 'E', 'F', 'G', 'H']:
-        ws2.column_dimensions[col].width = 18
+    # 工作表 2: 統計摘要
+    ws2 = workbook.add_worksheet("統計摘要")
+    ws2.set_column(0, SUMMARY_COLUMN_COUNT - 1, SUMMARY_COLUMN_WIDTH)
     
-    return wb
+    summary_rows = build_summary_rows(recommendations_df, df_original, calculation_type)
+    for row_num, (values, row_styles) in enumerate(summary_rows):
+        if row_styles is None:
+            ws2.write_row(row_num, 0, values)
+        else:
+            for col_num, (value, style) in enumerate(zip(values, row_styles)):
+                ws2.write(row_num, col_num, value, formats[style] if style else None)
+    
+    workbook.close()
+
+def hash_dataframe(df):
+    """以 pandas 向量化雜湊計算 DataFrame 的快取鍵，取代 Streamlit 預設的序列化雜湊"""
+    return tuple(df.columns), pd.util.hash_pandas_object(df, index=False).to_numpy().tobytes()
+
+@st.cache_data(show_spinner=False, max_entries=4)
+def load_uploaded_excel(file_bytes):
+    """以上傳文件內容作為快取鍵讀取 Excel，重新執行時不再重複解析"""
+    return read_input_excel(io.BytesIO(file_bytes))
+
+# Streamlit 預設只抽樣雜湊大型 DataFrame，內容改動後可能取回舊結果，因此以完整內容雜湊作快取鍵
+@st.cache_data(show_spinner=False, max_entries=4, hash_funcs={pd.DataFrame: hash_dataframe})
+def run_analysis(df, calculation_type="both"):
+    """預處理數據並生成退貨建議，相同輸入在重新執行時直接使用快取結果"""
+    processed_df = preprocess_data(df)
+    recommendations_df = generate_return_recommendations(processed_df, calculation_type)
+    return processed_df, recommendations_df
+
+@st.cache_data(show_spinner=False, max_entries=4, hash_funcs={pd.DataFrame: hash_dataframe})
+def build_report_bytes(recommendations_df, df_original, calculation_type="both"):
+    """生成 Excel 報告內容（bytes），避免重複下載時重建工作簿"""
+    buffer = io.BytesIO()
+    if xlsxwriter is not None:
+        write_excel_report_xlsxwriter(recommendations_df, df_original, calculation_type, buffer)
+    else:
+        wb = create_excel_report(recommendations_df, df_original, calculation_type)
+        wb.save(buffer)
+    return buffer.getvalue()
 
 def quality_check(recommendations_df, original_df):
     """質量檢查"""
@@ -527,46 +698,38 @@ def quality_check(recommendations_df, original_df):
         checks.append("✅ 無退貨建議生成")
         return checks
     
+    # 以 (Article, Site) 一次性對應原始數據（重複時取第一筆）
+    original_rows = original_df[['Article', 'Site', 'OM', 'SaSa Net Stock']].drop_duplicates(['Article', 'Site'])
+    joined = recommendations_df.merge(
+        original_rows.rename(columns={'Site': 'Return Site', 'OM': 'Original OM', 'SaSa Net Stock': 'Original Stock'}),
+        on=['Article', 'Return Site'],
+        how='left'
+    )
+    
     # 檢查 1: Article 和 OM 一致性
-    for _, row in recommendations_df.iterrows():
-        original_row = original_df[
-            (original_df['Article'] == row['Article']) &
-            (original_df['Site'] == row['Return Site'])
-        ]
-        if not original_row.empty and original_row.iloc[0]['OM'] == row['OM']:
-            continue
-        else:
-            checks.append(f"❌ Article {row['Article']} 和 OM {row['OM']} 不一致")
-            break
-    else:
+    om_mismatch = joined[joined['OM'] != joined['Original OM']]
+    if om_mismatch.empty:
         checks.append("✅ Article 和 OM 一致性檢查通過")
+    else:
+        first_bad = om_mismatch.iloc[0]
+        checks.append(f"❌ Article {first_bad['Article']} 和 OM {first_bad['OM']} 不一致")
     
     # 檢查 2: Return Qty 為正整數
-    if all(recommendations_df['Return Qty'] > 0):
+    return_qty = recommendations_df['Return Qty'].to_numpy()
+    if (return_qty > 0).all():
         checks.append("✅ 所有 Return Qty 為正整數")
     else:
         checks.append("❌ 存在非正整數的 Return Qty")
     
     # 檢查 3: Return Qty 不超過原庫存
-    exceeded = False
-    for _, row in recommendations_df.iterrows():
-        original_row = original_df[
-            (original_df['Article'] == row['Article']) &
-            (original_df['Site'] == row['Return Site'])
-        ]
-        if not original_row.empty:
-            original_stock = original_row.iloc[0]['SaSa Net Stock']
-            if row['Return Qty'] > original_stock:
-                exceeded = True
-                break
-    
-    if not exceeded:
+    if not (joined['Return Qty'] > joined['Original Stock']).any():
         checks.append("✅ Return Qty 不超過原庫存")
     else:
         checks.append("❌ 存在 Return Qty 超過原庫存的情況")
     
     # 檢查 4: Article 格式檢查
-    if all(len(str(art)) <= 12 for art in recommendations_df['Article']):
+    article_length = recommendations_df['Article'].astype(str).str.len().to_numpy()
+    if (article_length <= 12).all():
         checks.append("✅ Article 格式正確")
     else:
         checks.append("❌ Article 格式異常")
@@ -657,7 +820,7 @@ def main():
     
     if uploaded_file is not None:
         try:
-            current_file = pd.read_excel(uploaded_file, dtype={'Article': str})
+            current_file = load_uploaded_excel(uploaded_file.getvalue())
             file_source = f"上傳文件 ({uploaded_file.name})"
             st.markdown(f"""
             <div class="success-box">
@@ -684,6 +847,7 @@ def main():
         """, unsafe_allow_html=True)
         
         # KPI 卡片
+        source_columns = current_file.attrs.get('source_columns', list(current_file.columns))
         col1, col2, col3 = st.columns(3)
         with col1:
             st.markdown(f"""
@@ -695,7 +859,7 @@ def main():
         with col2:
             st.markdown(f"""
             <div class="metric-card">
-                <div style="font-size: 2rem; color: #667eea;">{current_file.shape[1]}</div>
+                <div style="font-size: 2rem; color: #667eea;">{len(source_columns)}</div>
                 <div style="color: #666; margin-top: 0.5rem;">欄位數</div>
             </div>
             """, unsafe_allow_html=True)
@@ -717,12 +881,11 @@ def main():
         if available_columns:
             st.dataframe(current_file[available_columns].head(), use_container_width=True)
         else:
-            st.markdown("""
+            st.markdown(f"""
             <div class="warning-box">
-                ⚠️ 未找到關鍵欄位，顯示所有欄位前 5 行
+                ⚠️ 未找到關鍵欄位，文件包含的欄位：{', '.join(map(str, source_columns))}
             </div>
             """, unsafe_allow_html=True)
-            st.dataframe(current_file.head(), use_container_width=True)
         
         # 計算類型選擇
         st.markdown('<div class="section-header">⚙️ 分析設置</div>', unsafe_allow_html=True)
@@ -747,11 +910,8 @@ def main():
         
         if st.button("🚀 生成退貨建議", type="primary", use_container_width=True):
             with st.spinner("正在處理數據..."):
-                # 數據預處理
-                processed_df = preprocess_data(current_file)
-                
-                # 生成退貨建議
-                recommendations_df = generate_return_recommendations(processed_df, selected_type)
+                # 數據預處理及生成退貨建議
+                processed_df, recommendations_df = run_analysis(current_file, selected_type)
                 
                 # 顯示結果
                 st.markdown("""
@@ -824,13 +984,13 @@ def main():
                     
                     with col1:
                         # OM 分布
-                        om_stats = recommendations_df.groupby('OM')['Return Qty'].sum().reset_index()
+                        om_stats = recommendations_df.groupby('OM', sort=False, observed=True)['Return Qty'].sum().reset_index()
                         st.bar_chart(om_stats.set_index('OM'))
                         st.caption("各 OM 退貨件數分布")
                     
                     with col2:
                         # 類型分布
-                        type_stats = recommendations_df.groupby('Type')['Return Qty'].sum().reset_index()
+                        type_stats = recommendations_df.groupby('Type', sort=False, observed=True)['Return Qty'].sum().reset_index()
                         st.bar_chart(type_stats.set_index('Type'))
                         st.caption("退貨類型分布")
                     
@@ -874,21 +1034,16 @@ def main():
                     st.markdown('<div class="section-header">💾 下載報告</div>', unsafe_allow_html=True)
                     
                     # 創建 Excel 文件
-                    wb = create_excel_report(recommendations_df, processed_df, selected_type)
+                    report_bytes = build_report_bytes(recommendations_df, processed_df, selected_type)
                     
                     # 生成文件名
                     current_date = datetime.now().strftime("%Y%m%d")
                     filename = f"退貨建議_{current_date}.xlsx"
                     
-                    # 保存到內存
-                    buffer = io.BytesIO()
-                    wb.save(buffer)
-                    buffer.seek(0)
-                    
                     # 提供下載按鈕
                     st.download_button(
                         label="📥 下載退貨建議報告",
-                        data=buffer.getvalue(),
+                        data=report_bytes,
                         file_name=filename,
                         mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
                         help=f"下載包含退貨建議和統計摘要的 Excel 文件",
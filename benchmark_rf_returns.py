@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+"""
+退貨建議分析系統 - RF 退貨計算效能測試
+比較 NumPy 與 numexpr（不同執行緒數）在不同行數下的耗時，用於設定 NUMEXPR_MIN_ROWS
+"""
+
+import os
+import sys
+import timeit
+
+# 添加當前路徑
+sys.path.append('/workspace')
+
+import app
+from test_app import _make_rf_arrays
+
+SIZES = [10_000, 100_000, 1_000_000]
+
+def time_call(arrays):
+    """取 5 次重複中最快一次的平均單次耗時（毫秒）"""
+    timer = timeit.Timer(lambda: app.calculate_rf_returns(*arrays))
+    return min(timer.repeat(repeat=5, number=5)) / 5 * 1000
+
+def main():
+    if app.numexpr is None:
+        print("❌ 未安裝 numexpr，無法比較")
+        return
+
+    # 只比較 NumPy 與 numexpr，停用 numba
+    app.rf_returns_kernel = None
+    cores = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count()
+    # numexpr 分支只在多執行緒時啟用，因此從 2 個執行緒開始比較
+    thread_counts = sorted({2, 4, 8, cores} & set(range(2, max(cores, 2) + 1)))
+    print(f"CPU 核心數: {cores}，NUMEXPR_MIN_ROWS = {app.NUMEXPR_MIN_ROWS}")
+    print(f"{'行數':>10} │ {'NumPy':>9} │ " + " │ ".join(f"numexpr×{t:<2}" for t in thread_counts))
+
+    original_min_rows = app.NUMEXPR_MIN_ROWS
+    original_threads = app.numexpr.get_num_threads()
+    try:
+        for n in SIZES:
+            arrays, threshold = _make_rf_arrays(n)
+            arrays = arrays + [threshold]
+            app.NUMEXPR_MIN_ROWS = n + 1
+            numpy_ms = time_call(arrays)
+            app.NUMEXPR_MIN_ROWS = 0
+            numexpr_ms = []
+            for threads in thread_counts:
+                app.numexpr.set_num_threads(threads)
+                numexpr_ms.append(time_call(arrays))
+            print(f"{n:>10,} │ {numpy_ms:7.2f}ms │ " + " │ ".join(f"{ms:8.2f}ms" for ms in numexpr_ms))
+    finally:
+        app.NUMEXPR_MIN_ROWS = original_min_rows
+        app.numexpr.set_num_threads(original_threads)
+
+if __name__ == "__main__":
+    main()
@@ -12,7 +12,8 @@ import sys
 sys.path.append('/workspace')
 
 # 導入主應用模塊的核心函數
-from app import preprocess_data, generate_return_recommendations
+from app import generate_return_recommendations
+from local_data import load_processed_excel
 
 def demo_calculation_types():
     """演示計算類型選擇功能"""
@@ -22,8 +23,7 @@ def demo_calculation_types():
     try:
         # 讀取真實數據
         print("📊 載入真實數據...")
-        real_data = pd.read_excel('/workspace/user_input_files/ELE_15Sep2025.XLSX', dtype={'Article': str})
-        processed_data = preprocess_data(real_data)
+        processed_data = load_processed_excel('/workspace/user_input_files/ELE_15Sep2025.XLSX')
         print(f"✅ 成功載入 {processed_data.shape[0]} 行數據")
         
         print("\n" + "=" * 60)
@@ -35,18 +35,34 @@ def demo_calculation_types():
         print("-" * 30)
         recommendations_all = generate_return_recommendations(processed_data, "both")
         
+        # ND 及 RF 的計算互不影響，只計算一次所有類型，再從結果中取出 ND / RF 部分
         if len(recommendations_all) > 0:
-            nd_count = (recommendations_all['Type'] == 'ND').sum()
-            rf_count = (recommendations_all['Type'] == 'RF').sum()
-            total_qty = recommendations_all['Transfer Qty'].sum()
-            
-            print(f"📈 退貨建議總數: {len(recommendations_all)} 條")
-            print(f"📦 總退貨件數: {total_qty} 件")
+            recommendations_nd = recommendations_all[recommendations_all['Type'] == 'ND']
+            recommendations_rf = recommendations_all[recommendations_all['Type'] == 'RF']
+            # 按 OM 及類型一次性統計退貨件數
+            om_type_qty = (recommendations_all.groupby(['OM', 'Type'], sort=False, observed=True)['Return Qty']
+                           .sum().unstack(fill_value=0))
+        else:
+            recommendations_nd = recommendations_rf = recommendations_all
+            om_type_qty = pd.DataFrame(columns=['ND', 'RF'], dtype=int)
+        
+        # 各部分共用的統計數字只計算一次
+        om_stats = om_type_qty.sum(axis=1).sort_values(ascending=False)
+        type_qty = om_type_qty.sum()
+        all_count = len(recommendations_all)
+        nd_count = len(recommendations_nd)
+        rf_count = len(recommendations_rf)
+        nd_qty = int(type_qty.get('ND', 0))
+        rf_qty = int(type_qty.get('RF', 0))
+        all_qty = nd_qty + rf_qty
+        
+        if all_count > 0:
+            print(f"📈 退貨建議總數: {all_count} 條")
+            print(f"📦 總退貨件數: {all_qty} 件")
             print(f"🔵 ND 類型: {nd_count} 條")
             print(f"🟡 RF 類型: {rf_count} 條")
             
             # 按 OM 統計
-            om_stats = recommendations_all.groupby('OM')['Transfer Qty'].sum().sort_values(ascending=False)
             print(f"\n📊 按 OM 退貨件數分布:")
             for om, qty in om_stats.head(5).items():
                 print(f"   • {om}: {qty} 件")
@@ -56,32 +72,28 @@ def demo_calculation_types():
         # 2. 只 ND 類型分析
         print("\n2️⃣  只計算 ND 類型退倉")
         print("-" * 30)
-        recommendations_nd = generate_return_recommendations(processed_data, "nd_only")
-        
-        if len(recommendations_nd) > 0:
-            total_qty_nd = recommendations_nd['Transfer Qty'].sum()
-            print(f"📈 ND 退倉建議: {len(recommendations_nd)} 條")
-            print(f"📦 ND 退倉件數: {total_qty_nd} 件")
+        if nd_count > 0:
+            print(f"📈 ND 退倉建議: {nd_count} 條")
+            print(f"📦 ND 退倉件數: {nd_qty} 件")
             
             # 顯示具體建議
             print(f"\n📋 ND 類型退倉詳情:")
-            for _, row in recommendations_nd.iterrows():
-                print(f"   • Article {row['Article']} - Site {row['Transfer Site']}: {row['Transfer Qty']} 件")
+            nd_details = ("   • Article " + recommendations_nd['Article'].astype(str)
+                          + " - Site " + recommendations_nd['Return Site'].astype(str)
+                          + ": " + recommendations_nd['Return Qty'].astype(str) + " 件")
+            print("\n".join(nd_details))
         else:
             print("ℹ️  暫無 ND 類型退倉建議")
         
         # 3. 只 RF 類型分析
         print("\n3️⃣  只計算 RF 類型過剩退倉")
         print("-" * 30)
-        recommendations_rf = generate_return_recommendations(processed_data, "rf_only")
-        
-        if len(recommendations_rf) > 0:
-            total_qty_rf = recommendations_rf['Transfer Qty'].sum()
-            print(f"📈 RF 過剩退倉建議: {len(recommendations_rf)} 條")
-            print(f"📦 RF 退倉件數: {total_qty_rf} 件")
+        if rf_count > 0:
+            print(f"📈 RF 過剩退倉建議: {rf_count} 條")
+            print(f"📦 RF 退倉件數: {rf_qty} 件")
             
             # 按 OM 統計
-            om_stats_rf = recommendations_rf.groupby('OM')['Transfer Qty'].sum().sort_values(ascending=False)
+            om_stats_rf = om_type_qty['RF'][om_type_qty['RF'] > 0].sort_values(ascending=False)
             print(f"\n📊 RF 類型按 OM 分布:")
             for om, qty in om_stats_rf.head(5).items():
                 print(f"   • {om}: {qty} 件")
@@ -97,13 +109,6 @@ def demo_calculation_types():
         print(f"│ 分析類型            │ 建議條數 │ 退貨件數 │ 百分比   │")
         print(f"├─────────────────────┼──────────┼──────────┼──────────┤")
         
-        all_count = len(recommendations_all)
-        all_qty = recommendations_all['Transfer Qty'].sum() if all_count > 0 else 0
-        nd_count = len(recommendations_nd)
-        nd_qty = recommendations_nd['Transfer Qty'].sum() if nd_count > 0 else 0
-        rf_count = len(recommendations_rf)
-        rf_qty = recommendations_rf['Transfer Qty'].sum() if rf_count > 0 else 0
-        
         print(f"│ 所有類型 (ND + RF)  │ {all_count:8d} │ {all_qty:8d} │ {100.0:7.1f}% │")
         nd_pct = (nd_qty / all_qty * 100) if all_qty > 0 else 0
         print(f"│ 只計算 ND 類型      │ {nd_count:8d} │ {nd_qty:8d} │ {nd_pct:7.1f}% │")
@@ -130,8 +135,8 @@ def demo_calculation_types():
             
             # 最活躍的 OM
             if len(recommendations_all) > 0:
-                top_om = recommendations_all.groupby('OM')['Transfer Qty'].sum().idxmax()
-                top_om_qty = recommendations_all.groupby('OM')['Transfer Qty'].sum().max()
+                top_om = om_stats.idxmax()
+                top_om_qty = om_stats.max()
                 print(f"🏆 最需要退貨調整的 OM：{top_om} ({top_om_qty} 件)")
         
         print("\n" + "=" * 60)
@@ -0,0 +1,17 @@
+#!/usr/bin/env python3
+"""
+退貨建議分析系統 - 本地數據讀取（演示及測試腳本使用）
+"""
+
+import functools
+import os
+
+from app import read_input_excel, preprocess_data
+
+@functools.lru_cache(maxsize=1)
+def _load_processed_excel(path, modified_time):
+    return preprocess_data(read_input_excel(path))
+
+def load_processed_excel(path):
+    """讀取並預處理本地 Excel 文件，同一進程內文件未更新時直接使用快取結果"""
+    return _load_processed_excel(path, os.path.getmtime(path))
@@ -8,12 +8,19 @@ import numpy as np
 from datetime import datetime
 import sys
 import os
+import io
+from openpyxl import load_workbook
 
 # 添加當前路徑
 sys.path.append('/workspace')
 
 # 導入主應用模塊的核心函數
-from app import preprocess_data, generate_return_recommendations, calculate_effective_sold_qty, quality_check
+import app
+from app import (preprocess_data, generate_return_recommendations, calculate_effective_sold_qty,
+                 calculate_effective_sold_qty_column, quality_check, create_excel_report,
+                 write_excel_report_xlsxwriter, xlsxwriter, calculate_rf_returns, rf_returns_loop,
+                 rf_returns_kernel, read_input_excel, get_top20_percent_threshold_column, run_analysis)
+from local_data import load_processed_excel
 
 def test_data_preprocessing():
     """測試數據預處理功能"""
@@ -40,6 +47,19 @@ def test_data_preprocessing():
     assert processed_df.shape[0] == 3, "數據行數不正確"
     assert 'Notes' in processed_df.columns, "缺少 Notes 欄位"
     assert processed_df['Article'].iloc[0] == '106545309001', "Article 格式處理異常"
+    assert processed_df['Effective Sold Qty'].tolist() == [3, 5, 8], "有效銷量計算異常"
+    
+    # Article 格式：去除小數部分、1-12 位數字補零至 12 位，其他值保持原樣
+    article_df = pd.DataFrame({'Article': [106545309001.0, ' 12345 ', 'ABC-1', None, '1234567890123']})
+    assert preprocess_data(article_df)['Article'].tolist() == [
+        '106545309001', '000000012345', 'ABC-1', '', '1234567890123'
+    ], "Article 格式處理異常"
+    
+    # 修改銷量後再次預處理，有效銷量應按新銷量重新計算
+    edited_df = processed_df.assign(**{'Last Month Sold Qty': [0, 200000, 0], 'MTD Sold Qty': [7, 0, 0]})
+    reprocessed_df = preprocess_data(edited_df)
+    assert reprocessed_df['Last Month Sold Qty'].tolist() == [0, 100000, 0], "銷量異常值校正異常"
+    assert reprocessed_df['Effective Sold Qty'].tolist() == [7, 100000, 0], "重新預處理後有效銷量未更新"
     
     print("✅ 數據預處理測試通過")
     return processed_df
@@ -50,17 +70,18 @@ def test_return_recommendations():
     
     # 創建測試數據
     test_data = {
-        'Article': ['106545309001', '106545309001', '106545309002', '106545309002'],
-        'Article Description': ['Test Product 1', 'Test Product 1', 'Test Product 2', 'Test Product 2'],
-        'OM': ['Candy', 'Candy', 'Hippo', 'Hippo'],
-        'RP Type': ['ND', 'RF', 'RF', 'RF'],
-        'Site': ['H001', 'H002', 'H003', 'H004'],
-        'SaSa Net Stock': [10, 15, 8, 20],
-        'Pending Received': [0, 3, 2, 5],
-        'Safety Stock': [5, 8, 4, 10],
-        'Last Month Sold Qty': [0, 2, 1, 8],  # H004 是高銷量店鋪
-        'MTD Sold Qty': [0, 1, 1, 4],
-        'Notes': ['', '', '', '']
+        'Article': ['106545309001', '106545309001', '106545309002', '106545309002', '106545309003', '106545309003'],
+        'Article Description': ['Test Product 1', 'Test Product 1', 'Test Product 2', 'Test Product 2',
+                                'Test Product 3', 'Test Product 3'],
+        'OM': ['Candy', 'Candy', 'Hippo', 'Hippo', 'Queenie', 'Queenie'],
+        'RP Type': ['ND', 'RF', 'RF', 'RF', 'ND', 'ND'],
+        'Site': ['H001', 'H002', 'H003', 'H004', 'H005', 'H006'],
+        'SaSa Net Stock': [10, 15, 8, 20, 6, 4],
+        'Pending Received': [0, 3, 2, 5, 0, 0],
+        'Safety Stock': [5, 8, 4, 10, 2, 2],
+        'Last Month Sold Qty': [0, 2, 1, 8, 3, 100000],  # H004 是高銷量店鋪；H005、H006 是有銷售記錄的 ND 店鋪
+        'MTD Sold Qty': [0, 1, 1, 4, 1, 0],
+        'Notes': ['', '', '', '', '', 'Last Month Sold Qty銷量數據超出範圍']  # H006 帶有預處理備註
     }
     
     df = pd.DataFrame(test_data)
@@ -92,7 +113,7 @@ def test_return_recommendations():
     # 基本驗證
     if len(recommendations_all) > 0:
         assert all(recommendations_all['Receive Site'] == 'D001'), "接收站點應為 D001"
-        assert all(recommendations_all['Transfer Qty'] > 0), "轉移數量應為正數"
+        assert all(recommendations_all['Return Qty'] > 0), "轉移數量應為正數"
     
     if len(recommendations_nd) > 0:
         assert all(recommendations_nd['Type'] == 'ND'), "ND 模式只應返回 ND 類型"
@@ -100,6 +121,30 @@ def test_return_recommendations():
     if len(recommendations_rf) > 0:
         assert all(recommendations_rf['Type'] == 'RF'), "RF 模式只應返回 RF 類型"
     
+    # 只 ND / 只 RF 的結果應與所有類型結果中的對應部分一致
+    assert len(recommendations_nd) == nd_count_all, f"ND 數量不一致: {len(recommendations_nd)} != {nd_count_all}"
+    assert len(recommendations_rf) == rf_count_all, f"RF 數量不一致: {len(recommendations_rf)} != {rf_count_all}"
+    
+    # 驗證具體建議內容：退貨店鋪、數量及備註（空白項不應留下多餘的分隔符）
+    sales_note = '曾有銷售記錄, Buyer需要留意是否需轉成RF及設定Safety'
+    range_note = 'Last Month Sold Qty銷量數據超出範圍'
+    assert recommendations_all['Return Site'].tolist() == ['H001', 'H003', 'H005', 'H006'], "退貨店鋪不正確"
+    assert recommendations_all['Return Qty'].tolist() == [10, 5, 6, 4], "退貨數量不正確"
+    assert recommendations_all['Notes'].tolist() == [
+        'ND類型退倉',
+        'RF類型過剩退倉',
+        f'ND類型退倉; {sales_note}',
+        f'ND類型退倉; {sales_note}; {range_note}'
+    ], "備註內容不正確"
+    
+    # Only ND 店舖模式：只退 MTD 無銷售的 ND 店鋪，且不加銷售記錄提示
+    print("\n測試 - 只計算 MTD 無銷售的 ND 店舖")
+    recommendations_nd_shop = generate_return_recommendations(df, "nd_shop_only")
+    assert recommendations_nd_shop['Return Site'].tolist() == ['H001', 'H006'], "nd_shop_only 退貨店鋪不正確"
+    assert recommendations_nd_shop['Return Qty'].tolist() == [10, 4], "nd_shop_only 退貨數量不正確"
+    assert recommendations_nd_shop['Notes'].tolist() == ['ND類型退倉', f'ND類型退倉; {range_note}'], \
+        "nd_shop_only 備註內容不正確"
+    
     print("✅ 退貨建議生成測試通過")
     return recommendations_all
 
@@ -118,8 +163,83 @@ def test_effective_sold_qty():
         result = calculate_effective_sold_qty(case)
         assert result == case['expected'], f"測試案例 {i+1} 失敗: 期望 {case['expected']}, 得到 {result}"
     
+    # 向量化版本應與逐行計算結果一致
+    column_result = calculate_effective_sold_qty_column(pd.DataFrame(test_cases))
+    assert column_result.tolist() == [case['expected'] for case in test_cases], "向量化有效銷量計算結果不一致"
+    
     print("✅ 有效銷量計算測試通過")
 
+def test_rf_return_kernels():
+    """測試 RF 退貨計算的向量化版本與逐行版本一致"""
+    print("🔧 測試 RF 退貨計算...")
+    
+    arrays, threshold = _make_rf_arrays(1000)
+    
+    keep, return_qty = calculate_rf_returns(*arrays, threshold)
+    loop_keep, loop_qty = rf_returns_loop(*arrays, threshold)
+    
+    assert (keep == loop_keep).all(), "退貨條件結果不一致"
+    assert (return_qty[keep] == loop_qty[loop_keep]).all(), "退貨數量結果不一致"
+    
+    if rf_returns_kernel is not None:
+        kernel_keep, kernel_qty = rf_returns_kernel(*arrays, threshold)
+        assert (kernel_keep == keep).all() and (kernel_qty[keep] == return_qty[keep]).all(), "numba 版本結果不一致"
+    
+    print("✅ RF 退貨計算測試通過")
+
+def test_numexpr_rf_returns():
+    """測試 RF 退貨計算的 numexpr 版本與 NumPy 版本一致"""
+    print("🔧 測試 numexpr RF 退貨計算...")
+    
+    if app.numexpr is None:
+        print("ℹ️  未安裝 numexpr，略過測試")
+        return
+    
+    n = app.NUMEXPR_MIN_ROWS
+    arrays, threshold = _make_rf_arrays(n, seed=1)
+    
+    # 停用 numba 並以多執行緒執行 numexpr，確保進入 numexpr 分支
+    kernel, threads, min_rows = app.rf_returns_kernel, app.numexpr.get_num_threads(), app.NUMEXPR_MIN_ROWS
+    app.rf_returns_kernel = None
+    app.numexpr.set_num_threads(2)
+    try:
+        numexpr_keep, numexpr_qty = calculate_rf_returns(*arrays, threshold)
+        app.NUMEXPR_MIN_ROWS = n + 1
+        numpy_keep, numpy_qty = calculate_rf_returns(*arrays, threshold)
+    finally:
+        app.rf_returns_kernel = kernel
+        app.numexpr.set_num_threads(threads)
+        app.NUMEXPR_MIN_ROWS = min_rows
+    
+    assert (numexpr_keep == numpy_keep).all(), "numexpr 版本退貨條件結果不一致"
+    assert (numexpr_qty[numpy_keep] == numpy_qty[numpy_keep]).all(), "numexpr 版本退貨數量結果不一致"
+    
+    print("✅ numexpr RF 退貨計算測試通過")
+
+def test_polars_thresholds():
+    """測試 polars 門檻計算與 pandas 版本一致"""
+    print("🔧 測試 polars 門檻計算...")
+    
+    if app.pl is None:
+        print("ℹ️  未安裝 polars，略過測試")
+        return
+    
+    processed_df = preprocess_data(_make_fixture(20000, seed=1))
+    pandas_thresholds = get_top20_percent_threshold_column(processed_df)
+    pandas_recommendations = generate_return_recommendations(processed_df, "both")
+    
+    app.USE_POLARS = True
+    try:
+        polars_thresholds = get_top20_percent_threshold_column(processed_df)
+        polars_recommendations = generate_return_recommendations(processed_df, "both")
+    finally:
+        app.USE_POLARS = False
+    
+    assert np.allclose(polars_thresholds.to_numpy(), pandas_thresholds.to_numpy()), "polars 門檻結果不一致"
+    assert polars_recommendations.equals(pandas_recommendations), "polars 版本退貨建議不一致"
+    
+    print("✅ polars 門檻計算測試通過")
+
 def test_quality_check():
     """測試質量檢查功能"""
     print("🔧 測試質量檢查功能...")
@@ -135,8 +255,8 @@ def test_quality_check():
     recommendations_data = {
         'Article': ['106545309001'],
         'OM': ['Candy'],
-        'Transfer Site': ['H001'],
-        'Transfer Qty': [5]
+        'Return Site': ['H001'],
+        'Return Qty': [5]
     }
     
     original_df = pd.DataFrame(original_data)
@@ -152,39 +272,173 @@ def test_quality_check():
     
     print("✅ 質量檢查測試通過")
 
+def test_read_input_excel():
+    """測試讀取上傳 Excel：混合數字及文字的欄位及完整欄位名稱"""
+    print("🔧 測試 Excel 讀取...")
+    
+    source = pd.DataFrame({
+        'Article': [106545309001, '106545309002'],
+        'OM': ['Candy', 5],
+        'RP Type': ['ND', 'RF'],
+        'Site': ['H001', 101],
+        'Remark': ['a', 'b'],
+        'SaSa Net Stock': [10, 15]
+    })
+    buffer = io.BytesIO()
+    source.to_excel(buffer, index=False)
+    
+    df = read_input_excel(io.BytesIO(buffer.getvalue()))
+    assert df['Site'].tolist() == ['H001', '101'], "Site 混合類型讀取異常"
+    assert df['OM'].tolist() == ['Candy', '5'], "OM 混合類型讀取異常"
+    assert 'Remark' not in df.columns, "不應讀取分析不需要的欄位"
+    assert df.attrs['source_columns'] == list(source.columns), "應保留工作表的完整欄位名稱"
+    
+    processed_df = preprocess_data(df)
+    assert processed_df['Site'].tolist() == ['H001', '101'], "Site 預處理結果異常"
+    
+    print("✅ Excel 讀取測試通過")
+
+def test_excel_report():
+    """測試 Excel 報告生成功能"""
+    print("🔧 測試 Excel 報告生成功能...")
+    
+    processed_df = preprocess_data(pd.DataFrame({
+        'Article': ['106545309001', '106545309001', '106545309002', '106545309002'],
+        'Article Description': ['Test Product 1', 'Test Product 1', None, 'Test Product 2'],  # H003 缺少描述
+        'OM': ['Candy', 'Candy', 'Hippo', 'Hippo'],
+        'RP Type': ['ND', 'RF', 'RF', 'RF'],
+        'Site': ['H001', 'H002', 'H003', 'H004'],
+        'SaSa Net Stock': [10, 15, 8, 20],
+        'Pending Received': [0, 3, 2, 5],
+        'Safety Stock': [5, 8, 4, 10],
+        'Last Month Sold Qty': [0, 2, 1, 8],
+        'MTD Sold Qty': [0, 1, 1, 4]
+    }))
+    recommendations = generate_return_recommendations(processed_df, "both")
+    
+    def sheet_values(workbook):
+        return {ws.title: list(ws.iter_rows(values_only=True)) for ws in workbook.worksheets}
+    
+    buffer = io.BytesIO()
+    create_excel_report(recommendations, processed_df, "both").save(buffer)
+    openpyxl_values = sheet_values(load_workbook(buffer))
+    
+    assert list(openpyxl_values) == ['退貨建議', '統計摘要'], "工作表名稱不正確"
+    assert len(openpyxl_values['退貨建議']) == len(recommendations) + 1, "退貨建議行數不正確"
+    
+    # 退貨前合計統計：每個 Article 一行，部分店鋪缺少描述時取第一個非空白描述，存貨按所有店鋪合計
+    summary_rows = openpyxl_values['統計摘要']
+    start = summary_rows.index(('Article', 'Product Desc', '原有存貨', '上月銷售', 'MTD銷售',
+                                'Safety QTY', '退貨總數量', '退貨後存貨')) + 1
+    assert summary_rows[start:start + 3] == [
+        ('106545309001', 'Test Product 1', 25, 2, 1, 13, 10, 15),
+        ('106545309002', 'Test Product 2', 28, 9, 5, 14, 5, 23),
+        (None,) * 8
+    ], "退貨前合計統計不正確"
+    
+    # xlsxwriter 版本應輸出相同內容
+    if xlsxwriter is not None:
+        buffer = io.BytesIO()
+        write_excel_report_xlsxwriter(recommendations, processed_df, "both", buffer)
+        xlsxwriter_values = sheet_values(load_workbook(buffer))
+        for title, rows in openpyxl_values.items():
+            assert [row for row in xlsxwriter_values[title] if any(row)] == [row for row in rows if any(row)], \
+                f"{title} 內容不一致"
+    
+    print("✅ Excel 報告生成測試通過")
+
+def _make_rf_arrays(n, seed=0):
+    """生成 RF 退貨計算的隨機輸入：六個整數陣列及約 10% 為 inf 的門檻陣列"""
+    rng = np.random.default_rng(seed)
+    arrays = [rng.integers(0, 30, n) for _ in range(6)]
+    threshold = np.where(rng.random(n) < 0.1, np.inf, rng.integers(0, 30, n).astype(float))
+    return arrays, threshold
+
+def _make_fixture(n, seed=0):
+    """以 NumPy 隨機數生成器整欄構建大規模測試數據"""
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({
+        'Article': pd.Series(rng.integers(0, max(n // 20, 1), n) + 106545309000).astype(str),
+        'Article Description': 'Synthetic Product',
+        'OM': rng.choice(['Candy', 'Hippo', 'Queenie', 'Sandy'], n),
+        'RP Type': rng.choice(['ND', 'RF'], n, p=[0.2, 0.8]),
+        'Site': pd.Series(np.arange(n)).astype(str).radd('H'),
+        'SaSa Net Stock': rng.integers(0, 30, n, dtype=np.int32),
+        'Pending Received': rng.integers(0, 5, n, dtype=np.int32),
+        'Safety Stock': rng.integers(0, 10, n, dtype=np.int32),
+        'Last Month Sold Qty': rng.integers(0, 20, n, dtype=np.int32),
+        'MTD Sold Qty': rng.integers(0, 20, n, dtype=np.int32)
+    })
+
+def test_run_analysis_cache():
+    """測試分析快取以完整內容作快取鍵：大型數據只改動一格也須重新計算"""
+    print("🔧 測試分析結果快取...")
+    
+    # Streamlit 預設只抽樣雜湊 5 萬行以上的 DataFrame
+    first_df = _make_fixture(60000)
+    second_df = first_df.copy()
+    nd_row = second_df.index[(second_df['RP Type'] == 'ND') & (second_df['SaSa Net Stock'] > 0)][0]
+    second_df.loc[nd_row, 'SaSa Net Stock'] = 0
+    
+    _, first_recommendations = run_analysis(first_df, "both")
+    _, second_recommendations = run_analysis(second_df, "both")
+    
+    assert len(second_recommendations) == len(first_recommendations) - 1, "修改數據後取回了舊的快取結果"
+    assert second_recommendations.equals(generate_return_recommendations(preprocess_data(second_df), "both")), \
+        "快取結果與直接計算不一致"
+    
+    print("✅ 分析結果快取測試通過")
+
+def test_with_synthetic_large():
+    """使用大規模合成數據測試退貨建議生成"""
+    print("🔧 使用大規模合成數據進行測試...")
+    
+    processed_data = preprocess_data(_make_fixture(1_000_000))
+    recommendations = generate_return_recommendations(processed_data, "both")
+    print(f"生成退貨建議: {len(recommendations)} 條")
+    
+    assert len(recommendations) > 0, "大規模數據應生成退貨建議"
+    assert all(result.startswith("✅") for result in quality_check(recommendations, processed_data)), "質量檢查未通過"
+    
+    # ND 類型全數退回，RF 類型每條至少退 2 件
+    original_stock = processed_data.set_index(['Article', 'Site'])['SaSa Net Stock']
+    recommended_stock = original_stock.reindex(pd.MultiIndex.from_arrays(
+        [recommendations['Article'].astype(str), recommendations['Return Site'].astype(str)])).to_numpy()
+    is_nd = (recommendations['Type'] == 'ND').to_numpy()
+    return_qty = recommendations['Return Qty'].to_numpy()
+    assert (return_qty[is_nd] == recommended_stock[is_nd]).all(), "ND 退貨數量應等於原庫存"
+    assert (return_qty[~is_nd] >= 2).all(), "RF 退貨數量應至少 2 件"
+    
+    print("✅ 大規模合成數據測試通過")
+
 def test_with_real_data():
     """使用真實數據進行測試"""
     print("🔧 使用真實數據進行測試...")
     
     try:
-        # 讀取真實數據
-        real_data = pd.read_excel('/workspace/user_input_files/ELE_15Sep2025.XLSX', dtype={'Article': str})
-        print(f"成功讀取真實數據: {real_data.shape[0]} 行 x {real_data.shape[1]} 列")
-        
-        # 預處理
-        processed_data = preprocess_data(real_data)
-        print(f"預處理完成: {processed_data.shape[0]} 行")
+        # 讀取並預處理真實數據（同一進程內及 Excel 未更新時重用結果）
+        processed_data = load_processed_excel('/workspace/user_input_files/ELE_15Sep2025.XLSX')
+        print(f"預處理完成: {processed_data.shape[0]} 行 x {processed_data.shape[1]} 列")
         
-        # 測試所有類型
+        # 只計算一次所有類型，ND / RF 部分直接從結果中取出
+        # （只 ND / 只 RF 模式與所有類型結果的一致性由 test_return_recommendations 驗證）
         print("\n測試 - 所有類型 (both)")
         recommendations_all = generate_return_recommendations(processed_data, "both")
         print(f"生成退貨建議: {len(recommendations_all)} 條")
         
-        # 測試只 ND
-        print("\n測試 - 只計算 ND 類型")
-        recommendations_nd = generate_return_recommendations(processed_data, "nd_only")
-        print(f"生成 ND 類型建議: {len(recommendations_nd)} 條")
-        
-        # 測試只 RF
-        print("\n測試 - 只計算 RF 類型")
-        recommendations_rf = generate_return_recommendations(processed_data, "rf_only")
-        print(f"生成 RF 類型建議: {len(recommendations_rf)} 條")
+        if len(recommendations_all) > 0:
+            recommendations_nd = recommendations_all[recommendations_all['Type'] == 'ND'].reset_index(drop=True)
+            recommendations_rf = recommendations_all[recommendations_all['Type'] == 'RF'].reset_index(drop=True)
+        else:
+            recommendations_nd = recommendations_rf = recommendations_all
+        print(f"其中 ND 類型建議: {len(recommendations_nd)} 條")
+        print(f"其中 RF 類型建議: {len(recommendations_rf)} 條")
         
         # 統計結果
         if len(recommendations_all) > 0:
             print("\n真實數據分析結果 (所有類型):")
             print(f"  總退貨建議數: {len(recommendations_all)}")
-            print(f"  總退貨件數: {recommendations_all['Transfer Qty'].sum()}")
+            print(f"  總退貨件數: {recommendations_all['Return Qty'].sum()}")
             print(f"  ND 類型: {(recommendations_all['Type'] == 'ND').sum()}")
             print(f"  RF 類型: {(recommendations_all['Type'] == 'RF').sum()}")
         
@@ -193,13 +447,10 @@ def test_with_real_data():
         print(f"  只 ND: {len(recommendations_nd)} 條")
         print(f"  只 RF: {len(recommendations_rf)} 條")
         
-        # 驗證結果的邏輯性
-        nd_count_all = (recommendations_all['Type'] == 'ND').sum() if len(recommendations_all) > 0 else 0
-        rf_count_all = (recommendations_all['Type'] == 'RF').sum() if len(recommendations_all) > 0 else 0
-        
-        assert len(recommendations_nd) == nd_count_all, f"ND 數量不一致: {len(recommendations_nd)} != {nd_count_all}"
-        assert len(recommendations_rf) == rf_count_all, f"RF 數量不一致: {len(recommendations_rf)} != {rf_count_all}"
+        # 驗證結果的邏輯性：所有建議都屬於 ND 或 RF 類型
         assert len(recommendations_all) == len(recommendations_nd) + len(recommendations_rf), "總數不等於 ND + RF"
+        if len(recommendations_all) > 0:
+            assert (recommendations_all['Return Qty'] > 0).all(), "退貨數量應為正數"
         
         print("✅ 真實數據測試通過")
         
@@ -222,9 +473,30 @@ def main():
         recommendations = test_return_recommendations()
         print()
         
+        test_rf_return_kernels()
+        print()
+        
+        test_numexpr_rf_returns()
+        print()
+        
+        test_polars_thresholds()
+        print()
+        
         test_quality_check()
         print()
         
+        test_read_input_excel()
+        print()
+        
+        test_excel_report()
+        print()
+        
+        test_run_analysis_cache()
+        print()
+        
+        test_with_synthetic_large()
+        print()
+        
         test_with_real_data()
         print()
         